@@ -11,13 +11,69 @@
 # limitations under the License.
 
 
+import atexit
+import contextlib
+import copy
 import unittest
-import mock
 
-import requires
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 
 _hook_args = {}
+_SENTINEL = object()
+
+# The keys are the function names that the hook attaches to.
+_EXPECTED_HOOK_ARGS = {
+    'joined': ('{requires:mysql-shared}-relation-joined', ),
+    'changed': ('{requires:mysql-shared}-relation-changed', ),
+    'departed': (('{requires:mysql-shared}-relation-'
+                  '{broken,departed}'), ),
+}
+
+# state calls expected from changed() and departed().
+_CALL_AVAIL = mock.call('{relation_name}.available')
+_CALL_AN = mock.call('{relation_name}.available.access_network')
+_CALL_SSL = mock.call('{relation_name}.available.ssl')
+
+# stored and expected prefixes for the set_prefix tests; set_prefix builds a
+# new list with + rather than appending, so these are never mutated.
+_PREFIXES_EMPTY = []
+_PREFIXES_NOVA = ['nova']
+_EXPECT_APPEND = ['nova', 'neutron']
+_EXPECT_NEW = ['neutron']
+
+# (method, prefix, getter, key) for the simple local/remote data accessors.
+_ACCESSORS = (
+    ('database', None, 'get_local', 'database'),
+    ('database', 'nova', 'get_local', 'nova_database'),
+    ('username', None, 'get_local', 'username'),
+    ('username', 'nova', 'get_local', 'nova_username'),
+    ('hostname', None, 'get_local', 'hostname'),
+    ('hostname', 'nova', 'get_local', 'nova_hostname'),
+    ('password', None, 'get_remote', 'password'),
+    ('password', 'nova', 'get_remote', 'nova_password'),
+    ('allowed_units', None, 'get_remote', 'allowed_units'),
+    ('allowed_units', 'nova', 'get_remote', 'nova_allowed_units'),
+)
+
+# get_remote data for the base_data_complete tests: a single prefix (or none)
+# is looked up in a fixed order, so those tests feed values in that order and
+# check the keys afterwards.
+_REMOTE_PREFIX_COMPLETE = ('novapass', 'nova_allowed')
+_REMOTE_PREFIX_CALLS = [mock.call('nova_password'),
+                        mock.call('nova_allowed_units')]
+_REMOTE_PREFIX_INCOMPLETE = {
+    'nova_password': 'novapass',
+    'nova_allowed_units': 'nova_allowed',
+    'neutron_password': None,
+    'neutron_allowed_units': 'neutron_allowed',
+}
+_REMOTE_NO_PREFIX_COMPLETE = ('pass', 'neutron_allowed')
+_REMOTE_NO_PREFIX_INCOMPLETE = (None, 'neutron_allowed')
+_REMOTE_BASE_CALLS = [mock.call('password'), mock.call('allowed_units')]
 
 
 def mock_hook(*args, **kwargs):
@@ -30,92 +86,118 @@ def mock_hook(*args, **kwargs):
     return inner
 
 
+# patch hook before requires is first imported so that its decorators run
+# mock_hook directly; the patch is undone when the interpreter exits.
+_patched_hook = mock.patch('charms.reactive.hook', mock_hook)
+_patched_hook.start()
+atexit.register(_patched_hook.stop)
+
+import requires
+
+
 class TestMySQLSharedRequires(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls._patched_hook = mock.patch('charms.reactive.hook', mock_hook)
-        cls._patched_hook_started = cls._patched_hook.start()
-        # force requires to rerun the mock_hook decorator:
-        reload(requires)
+        # constructing the relation joins a conversation, so build it once
+        # and hand each test a shallow copy; patch_msr only ever sets
+        # attributes on the copy, so the template is never modified.
+        cls._msr_template = requires.MySQLSharedRequires('some-relation', [])
+        # autospec the class once; patch_msr hands out its children so that
+        # patched attributes must exist and calls must match the signatures.
+        cls._mock_template = mock.create_autospec(
+            requires.MySQLSharedRequires, instance=True)
 
     @classmethod
     def tearDownClass(cls):
-        cls._patched_hook.stop()
-        cls._patched_hook_started = None
-        cls._patched_hook = None
-        # and fix any breakage we did to the module
-        reload(requires)
+        cls._msr_template = None
+        cls._mock_template = None
 
     def setUp(self):
-        self.msr = requires.MySQLSharedRequires('some-relation', [])
-        self._patches = {}
-        self._patches_start = {}
+        self.msr = copy.copy(self._msr_template)
+        self._saved = {}
 
     def tearDown(self):
+        # unittest keeps every TestCase alive until the run finishes, so drop
+        # the mocks entirely rather than leaving their names behind.
+        for k, v in self._saved.items():
+            self._restore(k, v)
+            delattr(self, k)
         self.msr = None
-        for k, v in self._patches.items():
-            v.stop()
-            setattr(self, k, None)
-        self._patches = None
-        self._patches_start = None
+        self._saved = None
+
+    def _mock_attr(self, attr, return_value):
+        mocked = getattr(self._mock_template, attr)
+        mocked.reset_mock()
+        mocked.return_value = return_value
+        mocked.side_effect = None
+        return mocked
+
+    def _restore(self, attr, original):
+        if original is _SENTINEL:
+            delattr(self.msr, attr)
+        else:
+            setattr(self.msr, attr, original)
 
     def patch_msr(self, attr, return_value=None):
-        mocked = mock.patch.object(self.msr, attr)
-        self._patches[attr] = mocked
-        started = mocked.start()
-        started.return_value = return_value
-        self._patches_start[attr] = started
-        setattr(self, attr, started)
+        # a plain setattr is far cheaper than mock.patch.object; only the
+        # first original is kept so re-patching an attribute still restores.
+        mocked = self._mock_attr(attr, return_value)
+        self._saved.setdefault(attr, self.msr.__dict__.get(attr, _SENTINEL))
+        setattr(self.msr, attr, mocked)
+        setattr(self, attr, mocked)
+        return mocked
+
+    @contextlib.contextmanager
+    def patched(self, attr, return_value=None):
+        # like patch_msr, but restored on leaving the block rather than in
+        # tearDown, for tests that only need a single patch.
+        original = self.msr.__dict__.get(attr, _SENTINEL)
+        mocked = self._mock_attr(attr, return_value)
+        setattr(self.msr, attr, mocked)
+        try:
+            yield mocked
+        finally:
+            self._restore(attr, original)
 
     def test_registered_hooks(self):
         # test that the hooks actually registered the relation expressions that
         # are meaningful for this interface: this is to handle regressions.
-        # The keys are the function names that the hook attaches to.
-        hook_patterns = {
-            'joined': ('{requires:mysql-shared}-relation-joined', ),
-            'changed': ('{requires:mysql-shared}-relation-changed', ),
-            'departed': (('{requires:mysql-shared}-relation-'
-                          '{broken,departed}'), ),
-        }
-        for k, v in _hook_args.items():
-            self.assertEqual(hook_patterns[k], v['args'])
+        self.assertEqual({k: v['args'] for k, v in _hook_args.items()},
+                         _EXPECTED_HOOK_ARGS)
 
     def test_joined(self):
-        self.patch_msr('set_state')
-        self.msr.joined()
-        self.set_state.assert_called_once_with('{relation_name}.connected')
+        with self.patched('set_state') as set_state:
+            self.msr.joined()
+            set_state.assert_called_once_with('{relation_name}.connected')
 
-    def test_changed(self):
+    def _make_changed_scenario(self, access_network, ssl):
         self.patch_msr('base_data_complete', True)
-        self.patch_msr('access_network_data_complete', False)
-        self.patch_msr('ssl_data_complete', False)
+        self.patch_msr('access_network_data_complete', access_network)
+        self.patch_msr('ssl_data_complete', ssl)
         self.patch_msr('set_state')
+
+    def test_changed_base(self):
+        self._make_changed_scenario(access_network=False, ssl=False)
         self.msr.changed()
-        self.set_state.assert_has_calls([
-            mock.call('{relation_name}.available'),
-        ])
-        self.patch_msr('access_network_data_complete', True)
+        self.assertEqual(self.set_state.call_args_list, [_CALL_AVAIL])
+
+    def test_changed_access_network(self):
+        self._make_changed_scenario(access_network=True, ssl=False)
         self.msr.changed()
-        self.set_state.assert_has_calls([
-            mock.call('{relation_name}.available'),
-            mock.call('{relation_name}.available.access_network'),
-        ])
-        self.patch_msr('ssl_data_complete', True)
+        self.assertEqual(self.set_state.call_args_list,
+                         [_CALL_AVAIL, _CALL_AN])
+
+    def test_changed_ssl(self):
+        self._make_changed_scenario(access_network=True, ssl=True)
         self.msr.changed()
-        self.set_state.assert_has_calls([
-            mock.call('{relation_name}.available'),
-            mock.call('{relation_name}.available.access_network'),
-            mock.call('{relation_name}.available.ssl'),
-        ])
+        self.assertEqual(self.set_state.call_args_list,
+                         [_CALL_AVAIL, _CALL_AN, _CALL_SSL])
 
     def test_departed(self):
-        self.patch_msr('remove_state')
-        self.msr.departed()
-        self.remove_state.assert_has_calls([
-            mock.call('{relation_name}.available'),
-            mock.call('{relation_name}.available.access_network'),
-        ])
+        with self.patched('remove_state') as remove_state:
+            self.msr.departed()
+            remove_state.assert_has_calls([_CALL_AVAIL, _CALL_AN])
 
     def test_configure_no_prefix(self):
         self.patch_msr('set_local')
@@ -144,139 +226,72 @@ class TestMySQLSharedRequires(unittest.TestCase):
         self.set_remote.assert_called_once_with(**expect)
 
     def test_set_prefix(self):
-        self.patch_msr('get_local', ['nova'])
+        self.patch_msr('get_local', _PREFIXES_NOVA)
         self.patch_msr('set_local')
         self.msr.set_prefix('neutron')
-        self.set_local.assert_called_once_with('prefixes', ['nova', 'neutron'])
+        self.set_local.assert_called_once_with('prefixes', _EXPECT_APPEND)
 
     def test_set_prefix_all_new(self):
-        self.patch_msr('get_local', [])
+        self.patch_msr('get_local', _PREFIXES_EMPTY)
         self.patch_msr('set_local')
         self.msr.set_prefix('neutron')
-        self.set_local.assert_called_once_with('prefixes', ['neutron'])
+        self.set_local.assert_called_once_with('prefixes', _EXPECT_NEW)
 
     def test_get_prefixes(self):
-        self.patch_msr('get_local')
-        self.msr.get_prefixes()
-        self.get_local.assert_called_once_with('prefixes')
-
-    def test_database_no_prefix(self):
-        self.patch_msr('get_local')
-        self.msr.database()
-        self.get_local.assert_called_once_with('database')
-
-    def test_database_prefix(self):
-        self.patch_msr('get_local')
-        self.msr.database('nova')
-        self.get_local.assert_called_once_with('nova_database')
+        with self.patched('get_local') as get_local:
+            self.msr.get_prefixes()
+            get_local.assert_called_once_with('prefixes')
 
-    def test_username_no_prefix(self):
+    def test_accessors(self):
         self.patch_msr('get_local')
-        self.msr.username()
-        self.get_local.assert_called_once_with('username')
-
-    def test_username_prefix(self):
-        self.patch_msr('get_local')
-        self.msr.username('nova')
-        self.get_local.assert_called_once_with('nova_username')
-
-    def test_hostname_no_prefix(self):
-        self.patch_msr('get_local')
-        self.msr.hostname()
-        self.get_local.assert_called_once_with('hostname')
-
-    def test_hostname_prefix(self):
-        self.patch_msr('get_local')
-        self.msr.hostname('nova')
-        self.get_local.assert_called_once_with('nova_hostname')
-
-    def test_password_no_prefix(self):
-        self.patch_msr('get_remote')
-        self.msr.password()
-        self.get_remote.assert_called_once_with('password')
-
-    def test_password_prefix(self):
         self.patch_msr('get_remote')
-        self.msr.password('nova')
-        self.get_remote.assert_called_once_with('nova_password')
-
-    def test_allowed_units_no_prefix(self):
-        self.patch_msr('get_remote')
-        self.msr.allowed_units()
-        self.get_remote.assert_called_once_with('allowed_units')
-
-    def test_allowed_units_prefix(self):
-        self.patch_msr('get_remote')
-        self.msr.allowed_units('nova')
-        self.get_remote.assert_called_once_with('nova_allowed_units')
+        for method, prefix, getter, key in _ACCESSORS:
+            mocked = getattr(self, getter)
+            mocked.reset_mock()
+            getattr(self.msr, method)(prefix)
+            self.assertEqual(mocked.call_args_list, [mock.call(key)],
+                             '{}({!r})'.format(method, prefix))
 
     def test_base_data_complete_prefix_complete(self):
         self.patch_msr('db_host', 'myhost')
         self.patch_msr('get_prefixes', ['nova'])
-
-        def _get_remote(key):
-            data = {
-                'nova_password': 'novapass',
-                'nova_allowed_units': 'nova_allowed',
-            }
-            return data[key]
         self.patch_msr('get_remote')
-        self.get_remote.side_effect = _get_remote
+        self.get_remote.side_effect = _REMOTE_PREFIX_COMPLETE
         self.assertTrue(self.msr.base_data_complete())
+        self.assertEqual(self.get_remote.call_args_list, _REMOTE_PREFIX_CALLS)
 
     def test_base_data_complete_prefix_incomplete(self):
         self.patch_msr('db_host', 'myhost')
         self.patch_msr('get_prefixes', ['nova', 'neutron'])
-
-        def _get_remote(key):
-            data = {
-                'nova_password': 'novapass',
-                'nova_allowed_units': 'nova_allowed',
-                'neutron_password': None,
-                'neutron_allowed_units': 'neutron_allowed',
-            }
-            return data[key]
         self.patch_msr('get_remote')
-        self.get_remote.side_effect = _get_remote
+        self.get_remote.side_effect = _REMOTE_PREFIX_INCOMPLETE.__getitem__
         self.assertFalse(self.msr.base_data_complete())
 
     def test_base_data_complete_no_prefix_complete(self):
         self.patch_msr('db_host', 'myhost')
         self.patch_msr('get_prefixes', [])
-
-        def _get_remote(key):
-            data = {
-                'password': 'pass',
-                'allowed_units': 'neutron_allowed',
-            }
-            return data[key]
         self.patch_msr('get_remote')
-        self.get_remote.side_effect = _get_remote
+        self.get_remote.side_effect = _REMOTE_NO_PREFIX_COMPLETE
         self.assertTrue(self.msr.base_data_complete())
+        self.assertEqual(self.get_remote.call_args_list, _REMOTE_BASE_CALLS)
 
     def test_base_data_complete_no_prefix_incomplete(self):
         self.patch_msr('db_host', 'myhost')
         self.patch_msr('get_prefixes', [])
-
-        def _get_remote(key):
-            data = {
-                'password': None,
-                'allowed_units': 'neutron_allowed',
-            }
-            return data[key]
         self.patch_msr('get_remote')
-        self.get_remote.side_effect = _get_remote
+        self.get_remote.side_effect = _REMOTE_NO_PREFIX_INCOMPLETE
         self.assertFalse(self.msr.base_data_complete())
+        self.assertEqual(self.get_remote.call_args_list, _REMOTE_BASE_CALLS)
 
     def test_access_network_data_complete(self):
-        self.patch_msr('access_network', '10.0.0.10/24')
-        self.assertTrue(self.msr.access_network_data_complete())
-        self.patch_msr('access_network', None)
-        self.assertFalse(self.msr.access_network_data_complete())
+        with self.patched('access_network', '10.0.0.10/24') as access_network:
+            self.assertTrue(self.msr.access_network_data_complete())
+            access_network.return_value = None
+            self.assertFalse(self.msr.access_network_data_complete())
 
     def test_ssl_data_complete(self):
         self.patch_msr('ssl_cert', 'mycert')
         self.patch_msr('ssl_key', 'mykey')
         self.assertTrue(self.msr.ssl_data_complete())
-        self.patch_msr('ssl_key', None)
+        self.ssl_key.return_value = None
         self.assertFalse(self.msr.ssl_data_complete())